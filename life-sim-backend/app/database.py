@@ -1,5 +1,6 @@
-from typing import Dict, Optional, List
+from typing import Callable, Dict, Optional, List
 from datetime import datetime
+import threading
 import uuid
 from app.models import User, GameState, Character, Place, GameObject, Action
 
@@ -10,6 +11,9 @@ class InMemoryDatabase:
         self.characters: Dict[str, Character] = {}
         self.places: Dict[str, Place] = {}
         self.objects: Dict[str, GameObject] = {}
+        self.game_state_versions: Dict[str, int] = {}
+        self._state_locks: Dict[str, threading.Lock] = {}
+        self._state_locks_guard = threading.Lock()
         
     def create_user(self, email: str, username: str, hashed_password: str) -> User:
         user_id = str(uuid.uuid4())
@@ -33,6 +37,7 @@ class InMemoryDatabase:
             last_updated=datetime.now()
         )
         self.game_states[user_id] = game_state
+        self.game_state_versions[user_id] = 0
         
         return user
     
@@ -48,9 +53,38 @@ class InMemoryDatabase:
     def get_game_state(self, user_id: str) -> Optional[GameState]:
         return self.game_states.get(user_id)
     
+    def get_game_state_version(self, user_id: str) -> int:
+        return self.game_state_versions.get(user_id, 0)
+    
     def update_game_state(self, user_id: str, game_state: GameState):
-        game_state.last_updated = datetime.now()
-        self.game_states[user_id] = game_state
+        with self._state_lock(user_id):
+            game_state.last_updated = datetime.now()
+            self.game_states[user_id] = game_state
+            self.game_state_versions[user_id] = self.get_game_state_version(user_id) + 1
+    
+    def mutate_game_state(
+        self, user_id: str, fn: Callable[[GameState], None]
+    ) -> Optional[GameState]:
+        # fn mutates the stored state in place while holding the per-user lock,
+        # so appends stay O(1). The version is bumped even if fn fails part way,
+        # since it may already have changed the state.
+        with self._state_lock(user_id):
+            game_state = self.game_states.get(user_id)
+            if game_state is None:
+                return None
+            try:
+                fn(game_state)
+            finally:
+                game_state.last_updated = datetime.now()
+                self.game_state_versions[user_id] = self.get_game_state_version(user_id) + 1
+            return game_state
+    
+    def _state_lock(self, user_id: str) -> threading.Lock:
+        lock = self._state_locks.get(user_id)
+        if lock is None:
+            with self._state_locks_guard:
+                lock = self._state_locks.setdefault(user_id, threading.Lock())
+        return lock
     
     def create_character(self, character: Character) -> Character:
         self.characters[character.id] = character
@@ -74,9 +108,8 @@ class InMemoryDatabase:
         return self.objects.get(object_id)
     
     def add_action_to_history(self, user_id: str, action: Action):
-        game_state = self.game_states.get(user_id)
-        if game_state:
-            game_state.action_history.append(action)
-            game_state.last_updated = datetime.now()
+        self.mutate_game_state(
+            user_id, lambda game_state: game_state.action_history.append(action)
+        )
 
 db = InMemoryDatabase()
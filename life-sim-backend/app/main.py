@@ -1,4 +1,4 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Request, status
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import timedelta, datetime
 import uuid
@@ -15,6 +15,10 @@ from app.auth import (
 )
 from app.ai_service import ai_service
 from app.image_service import image_service
+from app.rate_limit import (
+    limit_requests, limit_user_requests, render_image, admission_metrics,
+    AUTH_COST, IMAGE_RENDER_COST, STATE_UPDATE_COST
+)
 
 app = FastAPI()
 
@@ -31,7 +35,15 @@ app.add_middleware(
 async def healthz():
     return {"status": "ok"}
 
-@app.post("/api/auth/register", response_model=Token)
+@app.get("/api/metrics/admission")
+async def get_admission_metrics(current_user: User = Depends(get_current_user)):
+    return admission_metrics.snapshot()
+
+@app.post(
+    "/api/auth/register",
+    response_model=Token,
+    dependencies=[Depends(limit_requests(AUTH_COST))]
+)
 async def register(user_data: UserCreate):
     existing_user = db.get_user_by_email(user_data.email)
     if existing_user:
@@ -50,7 +62,11 @@ async def register(user_data: UserCreate):
     
     return {"access_token": access_token, "token_type": "bearer"}
 
-@app.post("/api/auth/login", response_model=Token)
+@app.post(
+    "/api/auth/login",
+    response_model=Token,
+    dependencies=[Depends(limit_requests(AUTH_COST))]
+)
 async def login(user_data: UserLogin):
     user = db.get_user_by_email(user_data.email)
     if not user or not verify_password(user_data.password, user.hashed_password):
@@ -76,8 +92,13 @@ async def get_current_user_info(current_user: User = Depends(get_current_user)):
         "created_at": current_user.created_at
     }
 
-@app.post("/api/character/create", response_model=Character)
+@app.post(
+    "/api/character/create",
+    response_model=Character,
+    dependencies=[Depends(limit_user_requests(IMAGE_RENDER_COST, renders=True))]
+)
 async def create_character(
+    request: Request,
     character_data: CharacterCreate,
     current_user: User = Depends(get_current_user)
 ):
@@ -92,20 +113,26 @@ async def create_character(
     )
     
     prompt = ai_service.generate_character_prompt(character)
-    image_url = image_service.generate_placeholder_image(prompt, "CHARACTER")
+    image_url = await render_image(
+        request, image_service.generate_placeholder_image, prompt, "CHARACTER"
+    )
     character.image_url = image_url
     
     db.create_character(character)
     
-    game_state = db.get_game_state(current_user.id)
-    if game_state:
+    def set_player_character(game_state: GameState):
         game_state.player_character = character
-        db.update_game_state(current_user.id, game_state)
+    
+    db.mutate_game_state(current_user.id, set_player_character)
     
     return character
 
-@app.post("/api/character/preview", response_model=Character)
-async def preview_character(character_data: CharacterCreate):
+@app.post(
+    "/api/character/preview",
+    response_model=Character,
+    dependencies=[Depends(limit_requests(IMAGE_RENDER_COST, renders=True))]
+)
+async def preview_character(request: Request, character_data: CharacterCreate):
     character_id = str(uuid.uuid4())
     character = Character(
         id=character_id,
@@ -117,7 +144,9 @@ async def preview_character(character_data: CharacterCreate):
     )
     
     prompt = ai_service.generate_character_prompt(character)
-    image_url = image_service.generate_placeholder_image(prompt, "CHARACTER")
+    image_url = await render_image(
+        request, image_service.generate_placeholder_image, prompt, "CHARACTER"
+    )
     character.image_url = image_url
     
     return character
@@ -132,59 +161,89 @@ async def get_game_state(current_user: User = Depends(get_current_user)):
         )
     return game_state
 
-@app.post("/api/game/generate-character", response_model=Character)
-async def generate_random_character(current_user: User = Depends(get_current_user)):
+@app.post(
+    "/api/game/generate-character",
+    response_model=Character,
+    dependencies=[Depends(limit_user_requests(IMAGE_RENDER_COST, renders=True))]
+)
+async def generate_random_character(
+    request: Request,
+    current_user: User = Depends(get_current_user)
+):
     character = ai_service.generate_random_character()
     
     prompt = ai_service.generate_character_prompt(character)
-    image_url = image_service.generate_placeholder_image(prompt, "CHARACTER")
+    image_url = await render_image(
+        request, image_service.generate_placeholder_image, prompt, "CHARACTER"
+    )
     character.image_url = image_url
     
     db.create_character(character)
     
-    game_state = db.get_game_state(current_user.id)
-    if game_state:
-        game_state.discovered_characters.append(character)
-        db.update_game_state(current_user.id, game_state)
+    db.mutate_game_state(
+        current_user.id,
+        lambda game_state: game_state.discovered_characters.append(character)
+    )
     
     return character
 
-@app.post("/api/game/generate-place", response_model=Place)
-async def generate_random_place(current_user: User = Depends(get_current_user)):
+@app.post(
+    "/api/game/generate-place",
+    response_model=Place,
+    dependencies=[Depends(limit_user_requests(IMAGE_RENDER_COST, renders=True))]
+)
+async def generate_random_place(
+    request: Request,
+    current_user: User = Depends(get_current_user)
+):
     place = ai_service.generate_random_place()
     
     prompt = ai_service.generate_place_prompt(place)
-    image_url = image_service.generate_placeholder_image(prompt, "PLACE")
+    image_url = await render_image(
+        request, image_service.generate_placeholder_image, prompt, "PLACE"
+    )
     place.image_url = image_url
     
     db.create_place(place)
     
-    game_state = db.get_game_state(current_user.id)
-    if game_state:
+    def discover_place(game_state: GameState):
         game_state.discovered_places.append(place)
         game_state.current_place = place
-        db.update_game_state(current_user.id, game_state)
+    
+    db.mutate_game_state(current_user.id, discover_place)
     
     return place
 
-@app.post("/api/game/generate-object", response_model=GameObject)
-async def generate_random_object(current_user: User = Depends(get_current_user)):
+@app.post(
+    "/api/game/generate-object",
+    response_model=GameObject,
+    dependencies=[Depends(limit_user_requests(IMAGE_RENDER_COST, renders=True))]
+)
+async def generate_random_object(
+    request: Request,
+    current_user: User = Depends(get_current_user)
+):
     obj = ai_service.generate_random_object()
     
     prompt = ai_service.generate_object_prompt(obj)
-    image_url = image_service.generate_placeholder_image(prompt, "OBJECT")
+    image_url = await render_image(
+        request, image_service.generate_placeholder_image, prompt, "OBJECT"
+    )
     obj.image_url = image_url
     
     db.create_object(obj)
     
-    game_state = db.get_game_state(current_user.id)
-    if game_state:
-        game_state.inventory.append(obj)
-        db.update_game_state(current_user.id, game_state)
+    db.mutate_game_state(
+        current_user.id,
+        lambda game_state: game_state.inventory.append(obj)
+    )
     
     return obj
 
-@app.post("/api/game/generate-action")
+@app.post(
+    "/api/game/generate-action",
+    dependencies=[Depends(limit_user_requests(STATE_UPDATE_COST))]
+)
 async def generate_random_action(
     request: GenerateActionRequest,
     current_user: User = Depends(get_current_user)
@@ -201,7 +260,10 @@ async def generate_random_action(
     
     return {"action": action_text, "timestamp": action.timestamp}
 
-@app.post("/api/game/travel-to-place/{place_id}")
+@app.post(
+    "/api/game/travel-to-place/{place_id}",
+    dependencies=[Depends(limit_user_requests(STATE_UPDATE_COST))]
+)
 async def travel_to_place(
     place_id: str,
     current_user: User = Depends(get_current_user)
@@ -213,9 +275,9 @@ async def travel_to_place(
             detail="Place not found"
         )
     
-    game_state = db.get_game_state(current_user.id)
-    if game_state:
+    def move_to_place(game_state: GameState):
         game_state.current_place = place
-        db.update_game_state(current_user.id, game_state)
+    
+    db.mutate_game_state(current_user.id, move_to_place)
     
     return {"message": f"Traveled to {place.name}", "place": place}
@@ -0,0 +1,229 @@
+import asyncio
+import ipaddress
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
+from typing import Callable, Dict, Optional, Tuple
+
+from fastapi import Depends, HTTPException, Request, status
+from starlette.concurrency import run_in_threadpool
+
+from app.auth import get_current_user
+from app.models import User
+
+BUCKET_CAPACITY = 30.0
+BUCKET_REFILL_PER_SECOND = 1.0
+MAX_TRACKED_CLIENTS = 10000
+CLIENT_IDLE_EXPIRY_SECONDS = 600
+EVICTION_SCAN_LIMIT = 8
+
+STATE_UPDATE_COST = 1.0
+IMAGE_RENDER_COST = 5.0
+AUTH_COST = 5.0
+
+# Authenticated requests are also charged to a per-IP bucket at this fraction
+# of their cost, so that many accounts from one address share a budget while
+# up to this many users behind one NAT can each use their full allowance.
+USERS_PER_IP = 10
+
+MAX_CONCURRENT_RENDERS = 4
+MAX_QUEUED_RENDERS = 16
+RENDER_RETRY_AFTER_SECONDS = 2
+
+# Comma-separated addresses or networks of reverse proxies whose
+# X-Forwarded-For header is trusted, e.g. "127.0.0.1,10.0.0.0/8".
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(proxy.strip())
+    for proxy in os.environ.get("TRUSTED_PROXIES", "").split(",")
+    if proxy.strip()
+]
+
+class TokenBucketLimiter:
+    def __init__(
+        self,
+        capacity: float = BUCKET_CAPACITY,
+        refill_per_second: float = BUCKET_REFILL_PER_SECOND,
+        max_clients: int = MAX_TRACKED_CLIENTS,
+        idle_expiry_seconds: float = CLIENT_IDLE_EXPIRY_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.max_clients = max_clients
+        self.idle_expiry_seconds = idle_expiry_seconds
+        self.clock = clock
+        # key -> (tokens, last_seen), ordered from least to most recently seen
+        self.buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, charges: Dict[str, float]) -> float:
+        # Charges every bucket in charges or none of them. Returns 0 when
+        # admitted, otherwise the number of seconds until the request would fit.
+        now = self.clock()
+        with self._lock:
+            self._evict(now, sum(1 for key in charges if key not in self.buckets))
+            levels = {key: self._refill(key, now) for key in charges}
+            wait = max(
+                (charges[key] - tokens) / self.refill_per_second
+                for key, tokens in levels.items()
+            )
+            if wait <= 0:
+                for key, tokens in levels.items():
+                    levels[key] = tokens - charges[key]
+            for key, tokens in levels.items():
+                self.buckets[key] = (tokens, now)
+                self.buckets.move_to_end(key)
+            return max(wait, 0.0)
+
+    def refund(self, charges: Dict[str, float]):
+        with self._lock:
+            for key, cost in charges.items():
+                if key in self.buckets:
+                    tokens, last_seen = self.buckets[key]
+                    self.buckets[key] = (min(self.capacity, tokens + cost), last_seen)
+
+    def _refill(self, key: str, now: float) -> float:
+        tokens, last_seen = self.buckets.get(key, (self.capacity, now))
+        return min(self.capacity, tokens + (now - last_seen) * self.refill_per_second)
+
+    def _evict(self, now: float, incoming: int):
+        while self.buckets:
+            key, (_, last_seen) = next(iter(self.buckets.items()))
+            if now - last_seen < self.idle_expiry_seconds:
+                break
+            del self.buckets[key]
+        while self.buckets and len(self.buckets) + incoming > self.max_clients:
+            # Dropping a bucket forgives its debt, so among the few least
+            # recently seen buckets drop the one closest to full. The scan is
+            # bounded to keep admission O(1) when the store is full.
+            oldest = islice(self.buckets, EVICTION_SCAN_LIMIT)
+            key = max(oldest, key=lambda key: self._refill(key, now))
+            del self.buckets[key]
+
+class RenderBudgetExceeded(HTTPException):
+    def __init__(self):
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Image rendering is overloaded, please retry later",
+            headers={"Retry-After": str(RENDER_RETRY_AFTER_SECONDS)},
+        )
+
+class RenderBudget:
+    def __init__(
+        self,
+        max_concurrent: int = MAX_CONCURRENT_RENDERS,
+        max_queued: int = MAX_QUEUED_RENDERS,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.pending = 0
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+    def is_saturated(self) -> bool:
+        return self.pending >= self.max_concurrent + self.max_queued
+
+    async def run(self, fn: Callable, *args):
+        if self.is_saturated():
+            raise RenderBudgetExceeded()
+        self.pending += 1
+        try:
+            async with self._semaphore:
+                return await run_in_threadpool(fn, *args)
+        finally:
+            self.pending -= 1
+
+class AdmissionMetrics:
+    def __init__(self):
+        self.routes: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, route: str, outcome: str):
+        with self._lock:
+            counts = self.routes.setdefault(route, {"admitted": 0, "rejected": 0, "shed": 0})
+            counts[outcome] += 1
+
+    def reclassify(self, route: str, old_outcome: str, new_outcome: str):
+        with self._lock:
+            counts = self.routes[route]
+            counts[old_outcome] -= 1
+            counts[new_outcome] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {route: dict(counts) for route, counts in self.routes.items()}
+
+limiter = TokenBucketLimiter()
+render_budget = RenderBudget()
+admission_metrics = AdmissionMetrics()
+
+def _route_path(request: Request) -> str:
+    route = request.scope.get("route")
+    return getattr(route, "path", request.url.path)
+
+def _is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+def _client_ip(request: Request) -> str:
+    client_ip = request.client.host if request.client else "unknown"
+    if not _is_trusted_proxy(client_ip):
+        return client_ip
+    # Walk the proxy chain from the nearest hop and stop at the first address
+    # that is not one of our proxies, since anything before it can be forged.
+    forwarded = request.headers.get("x-forwarded-for", "")
+    for address in reversed([hop.strip() for hop in forwarded.split(",") if hop.strip()]):
+        client_ip = address
+        if not _is_trusted_proxy(address):
+            break
+    return client_ip
+
+def _admit(request: Request, charges: Dict[str, float], renders: bool):
+    route = _route_path(request)
+    # Shed before charging so clients that honour Retry-After do not pay twice.
+    if renders and render_budget.is_saturated():
+        admission_metrics.record(route, "shed")
+        raise RenderBudgetExceeded()
+    wait = limiter.try_acquire(charges)
+    if wait > 0:
+        admission_metrics.record(route, "rejected")
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Rate limit exceeded",
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
+    request.state.admission = charges
+    admission_metrics.record(route, "admitted")
+
+def limit_requests(cost: float, renders: bool = False):
+    async def check(request: Request):
+        _admit(request, {f"ip:{_client_ip(request)}": cost}, renders)
+    return check
+
+def limit_user_requests(cost: float, renders: bool = False):
+    async def check(request: Request, current_user: User = Depends(get_current_user)):
+        charges = {
+            f"user:{current_user.id}": cost,
+            f"users-ip:{_client_ip(request)}": cost / USERS_PER_IP,
+        }
+        _admit(request, charges, renders)
+    return check
+
+async def render_image(request: Request, fn: Callable, *args):
+    try:
+        return await render_budget.run(fn, *args)
+    except RenderBudgetExceeded:
+        # The budget filled up after admission: give the tokens back and
+        # count the request as shed rather than admitted.
+        admission: Optional[Dict[str, float]] = getattr(request.state, "admission", None)
+        if admission:
+            limiter.refund(admission)
+            admission_metrics.reclassify(_route_path(request), "admitted", "shed")
+        else:
+            admission_metrics.record(_route_path(request), "shed")
+        raise
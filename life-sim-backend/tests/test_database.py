@@ -0,0 +1,127 @@
+import threading
+import unittest
+import uuid
+from datetime import datetime
+
+from app.database import InMemoryDatabase
+from app.models import Action, GameObject
+
+THREADS_PER_USER = 4
+WRITES_PER_THREAD = 100
+
+def make_action() -> Action:
+    return Action(id=str(uuid.uuid4()), description="test", timestamp=datetime.now())
+
+def make_object() -> GameObject:
+    return GameObject(
+        id=str(uuid.uuid4()), name="test", description="test", created_at=datetime.now()
+    )
+
+def run_threads(targets):
+    threads = [threading.Thread(target=fn, args=args) for fn, args in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+class MutateGameStateTest(unittest.TestCase):
+    def setUp(self):
+        self.db = InMemoryDatabase()
+
+    def create_users(self, count: int):
+        return [
+            self.db.create_user(f"user{i}@example.com", f"user{i}", "hash").id
+            for i in range(count)
+        ]
+
+    def test_concurrent_writes_are_not_lost(self):
+        users = self.create_users(20)
+
+        def write_actions(user_id):
+            for _ in range(WRITES_PER_THREAD):
+                self.db.add_action_to_history(user_id, make_action())
+
+        run_threads(
+            (write_actions, (user_id,))
+            for user_id in users
+            for _ in range(THREADS_PER_USER)
+        )
+
+        expected = THREADS_PER_USER * WRITES_PER_THREAD
+        for user_id in users:
+            self.assertEqual(len(self.db.get_game_state(user_id).action_history), expected)
+            self.assertEqual(self.db.get_game_state_version(user_id), expected)
+
+    def test_mixed_mutations_are_not_lost(self):
+        [user_id] = self.create_users(1)
+
+        def append_inventory_and_action(_):
+            for _ in range(WRITES_PER_THREAD):
+                self.db.mutate_game_state(
+                    user_id, lambda game_state: game_state.inventory.append(make_object())
+                )
+                self.db.add_action_to_history(user_id, make_action())
+
+        run_threads((append_inventory_and_action, (i,)) for i in range(THREADS_PER_USER))
+
+        game_state = self.db.get_game_state(user_id)
+        expected = THREADS_PER_USER * WRITES_PER_THREAD
+        self.assertEqual(len(game_state.inventory), expected)
+        self.assertEqual(len(game_state.action_history), expected)
+        self.assertEqual(self.db.get_game_state_version(user_id), 2 * expected)
+
+    def test_users_do_not_serialize_each_other(self):
+        # Both mutations wait inside their user's lock until the other arrives,
+        # which only succeeds if the two locks are held at the same time.
+        users = self.create_users(2)
+        barrier = threading.Barrier(len(users), timeout=5)
+        errors = []
+
+        def wait_for_other_user(game_state):
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError as error:
+                errors.append(error)
+
+        run_threads(
+            (self.db.mutate_game_state, (user_id, wait_for_other_user))
+            for user_id in users
+        )
+
+        self.assertEqual(errors, [])
+
+    def test_same_user_mutations_do_not_overlap(self):
+        [user_id] = self.create_users(1)
+        inside = []
+        overlaps = []
+
+        def record_overlap(game_state):
+            inside.append(1)
+            if len(inside) > 1:
+                overlaps.append(1)
+            game_state.action_history.append(make_action())
+            inside.pop()
+
+        def write(_):
+            for _ in range(WRITES_PER_THREAD):
+                self.db.mutate_game_state(user_id, record_overlap)
+
+        run_threads((write, (i,)) for i in range(THREADS_PER_USER))
+
+        self.assertEqual(overlaps, [])
+
+    def test_failed_mutation_still_bumps_version(self):
+        [user_id] = self.create_users(1)
+
+        def append_then_fail(game_state):
+            game_state.action_history.append(make_action())
+            raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            self.db.mutate_game_state(user_id, append_then_fail)
+
+        self.assertEqual(len(self.db.get_game_state(user_id).action_history), 1)
+        self.assertEqual(self.db.get_game_state_version(user_id), 1)
+
+    def test_mutate_missing_user_returns_none(self):
+        self.assertIsNone(self.db.mutate_game_state("missing", lambda game_state: None))
@@ -0,0 +1,268 @@
+import asyncio
+import ipaddress
+import threading
+import unittest
+from unittest import mock
+
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+from app import rate_limit
+from app.auth import decode_token
+from app.main import app
+from app.rate_limit import (
+    AdmissionMetrics, RenderBudget, RenderBudgetExceeded, TokenBucketLimiter,
+    IMAGE_RENDER_COST, STATE_UPDATE_COST, USERS_PER_IP
+)
+
+PREVIEW_PAYLOAD = {
+    "name": "Test",
+    "attributes": {"strength": 5, "intelligence": 5, "charisma": 5, "agility": 5, "luck": 5},
+    "characteristics": {
+        "hair_color": "brown", "eye_color": "green", "skin_tone": "fair",
+        "height": "average", "build": "slim"
+    },
+}
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+def make_request(client_host: str = "203.0.113.1", forwarded_for: str = None) -> Request:
+    headers = []
+    if forwarded_for is not None:
+        headers.append((b"x-forwarded-for", forwarded_for.encode()))
+    return Request({
+        "type": "http",
+        "method": "POST",
+        "scheme": "http",
+        "server": ("testserver", 80),
+        "path": "/api/test",
+        "query_string": b"",
+        "headers": headers,
+        "client": (client_host, 12345),
+    })
+
+class TokenBucketLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = TokenBucketLimiter(
+            capacity=10, refill_per_second=1, max_clients=3,
+            idle_expiry_seconds=60, clock=self.clock
+        )
+
+    def test_charges_until_empty_then_reports_wait(self):
+        self.assertEqual(self.limiter.try_acquire({"a": 5}), 0)
+        self.assertEqual(self.limiter.try_acquire({"a": 5}), 0)
+        self.assertEqual(self.limiter.try_acquire({"a": 5}), 5)
+
+        self.clock.now += 5
+        self.assertEqual(self.limiter.try_acquire({"a": 5}), 0)
+
+    def test_refill_is_capped_at_capacity(self):
+        self.limiter.try_acquire({"a": 10})
+        self.clock.now += 50
+        self.assertEqual(self.limiter.try_acquire({"a": 10}), 0)
+        self.assertEqual(self.limiter.try_acquire({"a": 1}), 1)
+
+    def test_charges_all_keys_or_none(self):
+        self.limiter.try_acquire({"a": 8})
+
+        self.assertEqual(self.limiter.try_acquire({"a": 5, "b": 5}), 3)
+        self.assertEqual(self.limiter.buckets["b"][0], 10)
+
+        self.clock.now += 3
+        self.assertEqual(self.limiter.try_acquire({"a": 5, "b": 5}), 0)
+        self.assertEqual(self.limiter.buckets["a"][0], 0)
+        self.assertEqual(self.limiter.buckets["b"][0], 5)
+
+    def test_refund_returns_tokens(self):
+        self.limiter.try_acquire({"a": 10})
+        self.limiter.refund({"a": 4})
+        self.assertEqual(self.limiter.try_acquire({"a": 4}), 0)
+
+    def test_idle_buckets_expire(self):
+        self.limiter.try_acquire({"a": 1})
+        self.clock.now += 30
+        self.limiter.try_acquire({"b": 1})
+        self.clock.now += 31
+        self.limiter.try_acquire({"c": 1})
+
+        self.assertEqual(list(self.limiter.buckets), ["b", "c"])
+
+    def test_never_exceeds_max_clients(self):
+        self.limiter.try_acquire({"a": 1})
+        self.limiter.try_acquire({"b": 1})
+        self.limiter.try_acquire({"c": 1, "d": 1})
+
+        self.assertLessEqual(len(self.limiter.buckets), self.limiter.max_clients)
+        self.assertIn("c", self.limiter.buckets)
+        self.assertIn("d", self.limiter.buckets)
+
+    def test_evicts_full_buckets_before_throttled_ones(self):
+        self.limiter.try_acquire({"throttled": 10})
+        self.limiter.try_acquire({"recovering": 2})
+        self.limiter.try_acquire({"fresh": 1})
+        self.clock.now += 1
+
+        self.limiter.try_acquire({"new": 1})
+
+        self.assertEqual(list(self.limiter.buckets), ["throttled", "recovering", "new"])
+        self.assertEqual(self.limiter.try_acquire({"throttled": 5}), 4)
+
+        self.limiter.try_acquire({"newer": 1})
+
+        self.assertEqual(list(self.limiter.buckets), ["new", "throttled", "newer"])
+
+    def test_eviction_only_scans_least_recently_seen_buckets(self):
+        limiter = TokenBucketLimiter(
+            capacity=10, refill_per_second=1, max_clients=20, clock=self.clock
+        )
+        for i in range(19):
+            limiter.try_acquire({f"debt{i}": 10})
+        limiter.try_acquire({"full": 0})
+
+        limiter.try_acquire({"new": 1})
+
+        self.assertIn("full", limiter.buckets)
+        self.assertNotIn("debt0", limiter.buckets)
+        self.assertEqual(len(limiter.buckets), 20)
+
+class RenderBudgetTest(unittest.TestCase):
+    def test_sheds_once_concurrency_and_queue_are_full(self):
+        async def scenario():
+            budget = RenderBudget(max_concurrent=2, max_queued=1)
+            release = threading.Event()
+            tasks = [asyncio.create_task(budget.run(release.wait)) for _ in range(3)]
+            while budget.pending < 3:
+                await asyncio.sleep(0)
+
+            self.assertTrue(budget.is_saturated())
+            with self.assertRaises(RenderBudgetExceeded) as error:
+                await budget.run(release.wait)
+            self.assertEqual(error.exception.status_code, 503)
+            self.assertIn("Retry-After", error.exception.headers)
+
+            release.set()
+            await asyncio.gather(*tasks)
+            self.assertEqual(budget.pending, 0)
+
+        asyncio.run(scenario())
+
+    def test_late_shed_refunds_tokens_and_reclassifies(self):
+        limiter = TokenBucketLimiter(capacity=10, refill_per_second=1, clock=FakeClock())
+        metrics = AdmissionMetrics()
+        budget = RenderBudget(max_concurrent=1, max_queued=0)
+        request = make_request()
+
+        with mock.patch.object(rate_limit, "limiter", limiter), \
+                mock.patch.object(rate_limit, "admission_metrics", metrics), \
+                mock.patch.object(rate_limit, "render_budget", budget):
+            rate_limit._admit(request, {"ip:a": IMAGE_RENDER_COST}, renders=True)
+            budget.pending = 1
+            with self.assertRaises(RenderBudgetExceeded):
+                asyncio.run(rate_limit.render_image(request, lambda: None))
+
+        self.assertEqual(limiter.buckets["ip:a"][0], 10)
+        self.assertEqual(metrics.snapshot()["/api/test"], {"admitted": 0, "rejected": 0, "shed": 1})
+
+class ClientIpTest(unittest.TestCase):
+    def test_ignores_forwarded_for_from_untrusted_client(self):
+        request = make_request("203.0.113.1", forwarded_for="198.51.100.7")
+        with mock.patch.object(rate_limit, "TRUSTED_PROXIES", []):
+            self.assertEqual(rate_limit._client_ip(request), "203.0.113.1")
+
+    def test_uses_first_untrusted_hop_behind_trusted_proxies(self):
+        proxies = [ipaddress.ip_network("10.0.0.0/8")]
+        request = make_request("10.0.0.1", forwarded_for="1.2.3.4, 198.51.100.7, 10.0.0.2")
+        with mock.patch.object(rate_limit, "TRUSTED_PROXIES", proxies):
+            self.assertEqual(rate_limit._client_ip(request), "198.51.100.7")
+
+    def test_falls_back_to_proxy_without_forwarded_for(self):
+        proxies = [ipaddress.ip_network("10.0.0.1/32")]
+        with mock.patch.object(rate_limit, "TRUSTED_PROXIES", proxies):
+            self.assertEqual(rate_limit._client_ip(make_request("10.0.0.1")), "10.0.0.1")
+
+class AdmissionEndpointTest(unittest.TestCase):
+    def setUp(self):
+        self.client = TestClient(app)
+        self.limiter = TokenBucketLimiter(capacity=10, refill_per_second=1, clock=FakeClock())
+        self.metrics = AdmissionMetrics()
+        self.budget = RenderBudget()
+        patches = [
+            mock.patch.object(rate_limit, "limiter", self.limiter),
+            mock.patch.object(rate_limit, "admission_metrics", self.metrics),
+            mock.patch.object(rate_limit, "render_budget", self.budget),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_rate_limited_requests_get_429_with_retry_after(self):
+        for _ in range(2):
+            response = self.client.post("/api/character/preview", json=PREVIEW_PAYLOAD)
+            self.assertEqual(response.status_code, 200)
+
+        response = self.client.post("/api/character/preview", json=PREVIEW_PAYLOAD)
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers["Retry-After"], "5")
+        self.assertEqual(
+            self.metrics.snapshot()["/api/character/preview"],
+            {"admitted": 2, "rejected": 1, "shed": 0},
+        )
+
+    def test_saturated_render_budget_sheds_without_charging(self):
+        self.budget.pending = self.budget.max_concurrent + self.budget.max_queued
+
+        response = self.client.post("/api/character/preview", json=PREVIEW_PAYLOAD)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response.headers)
+        self.assertEqual(self.limiter.buckets, {})
+        self.assertEqual(
+            self.metrics.snapshot()["/api/character/preview"],
+            {"admitted": 0, "rejected": 0, "shed": 1},
+        )
+
+    def test_registration_is_limited_per_ip(self):
+        for i in range(2):
+            response = self.client.post("/api/auth/register", json={
+                "email": f"limited{i}@example.com", "username": "u", "password": "p"
+            })
+            self.assertEqual(response.status_code, 200)
+
+        response = self.client.post("/api/auth/register", json={
+            "email": "limited2@example.com", "username": "u", "password": "p"
+        })
+
+        self.assertEqual(response.status_code, 429)
+
+    def test_authenticated_requests_charge_user_and_shared_ip_buckets(self):
+        token = self.client.post("/api/auth/register", json={
+            "email": "charged@example.com", "username": "u", "password": "p"
+        }).json()["access_token"]
+
+        response = self.client.post(
+            "/api/game/generate-action",
+            json={"context": ""},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        capacity = self.limiter.capacity
+        self.assertEqual(
+            self.limiter.buckets[f"user:{decode_token(token)}"][0],
+            capacity - STATE_UPDATE_COST,
+        )
+        self.assertAlmostEqual(
+            self.limiter.buckets["users-ip:testclient"][0],
+            capacity - STATE_UPDATE_COST / USERS_PER_IP,
+        )
+
+    def test_metrics_require_authentication(self):
+        response = self.client.get("/api/metrics/admission")
+        self.assertIn(response.status_code, (401, 403))